@@ -17,7 +17,9 @@ CHANGELOG_EXTENSIONS = (
     "doc",
     "trivial",
 )
-CHANGELOG_ENTRY_REREX = r"^[\d]+\.({})\.rst$".format("|".join(CHANGELOG_EXTENSIONS))
+# Entries are named after the issue they address, or, if there's none, are orphan entries,
+# named with a leading '+'
+CHANGELOG_ENTRY_REREX = r"^([\d]+|\+[\w-]+)\.({})\.rst$".format("|".join(CHANGELOG_EXTENSIONS))
 CHANGELOG_ENTRY_RE = re.compile(CHANGELOG_ENTRY_REREX)
 
 
@@ -4,18 +4,16 @@ Container based factories.
 ..
     PYTEST_DONT_REWRITE
 """
-import atexit
 import contextlib
+import importlib.util
 import logging
 import os
 
 import _pytest._version
 import attr
 import pytest
-from pytestshellutils.customtypes import Callback
 from pytestshellutils.exceptions import FactoryNotStarted
 from pytestshellutils.shell import BaseFactory
-from pytestshellutils.utils import ports
 from pytestshellutils.utils import time
 from pytestshellutils.utils.processes import ProcessResult
 
@@ -23,61 +21,31 @@ from saltfactories import bases
 from saltfactories import CODE_ROOT_DIR
 from saltfactories.daemons import minion
 from saltfactories.utils import random_string
-
-try:
-    import docker
-    from docker.errors import DockerException, APIError, NotFound
-
-    HAS_DOCKER = True
-except ImportError:  # pragma: no cover
-    HAS_DOCKER = False
-
-    class DockerException(Exception):
-        """
-        Define DockerException to avoid NameError.
-        """
-
-    class APIError(Exception):
-        """
-        Define APIError to avoid NameError.
-        """
-
-    class NotFound(Exception):
-        """
-        Define NotFound to avoid NameError.
-        """
-
-
-try:
-    from requests.exceptions import ConnectionError as RequestsConnectionError
-
-    HAS_REQUESTS = True
-except ImportError:  # pragma: no cover
-    HAS_REQUESTS = False
-
-    class RequestsConnectionError(ConnectionError):
-        """
-        Define RequestsConnectionError to avoid NameError.
-        """
-
-
-try:
-    import pywintypes
-
-    PyWinTypesError = pywintypes.error  # pragma: no cover
-except ImportError:
-
-    class PyWinTypesError(Exception):
-        """
-        Define PyWinTypesError to avoid NameError.
-        """
-
+from saltfactories.utils.containers import _Callback
+from saltfactories.utils.containers import _client_connectable
+from saltfactories.utils.containers import _ContainerStatus
+from saltfactories.utils.containers import _get_connectable_ports
+from saltfactories.utils.containers import _get_container_logs
+from saltfactories.utils.containers import _get_default_docker_client
+from saltfactories.utils.containers import _get_docker
+from saltfactories.utils.containers import _poll_intervals
+from saltfactories.utils.containers import _register_started_container
+from saltfactories.utils.containers import _run_callbacks
+from saltfactories.utils.containers import _unregister_started_container
+from saltfactories.utils.containers import _wait_for_container_start
+
+# The docker and requests libraries are only imported when actually needed, see
+# saltfactories.utils.containers
+HAS_DOCKER = importlib.util.find_spec("docker") is not None
+HAS_REQUESTS = importlib.util.find_spec("requests") is not None
 
 log = logging.getLogger(__name__)
 
 PYTEST_GE_7 = getattr(_pytest._version, "version_tuple", (-1, -1)) >= (7, 0)
 
 
+# Container and SaltDaemon can't be slotted. Their subclasses also inherit from the, slotted,
+# pytestshellutils daemon classes, which would trigger an instance lay-out conflict.
 @attr.s(kw_only=True)
 class Container(BaseFactory):
     """
@@ -143,6 +111,30 @@ class Container(BaseFactory):
         :keyword Docker docker_client:
             An instance of the python docker client to use.
             When nothing is passed, a default docker client is instantiated.
+        :keyword int docker_client_pool_size:
+            The maximum number of connections the default docker client keeps open to the docker
+            daemon, for each connection pool. Useful when running many concurrent docker operations.
+            Defaults to the docker library default, 10. Ignored when ``docker_client`` is passed.
+        :keyword float initial_poll_interval:
+            The number of seconds to wait before the first re-check of the container status
+            while starting. The wait doubles on each re-check, up to ``max_poll_interval``.
+        :keyword float max_poll_interval:
+            The maximum number of seconds to wait between container status re-checks.
+        :keyword int container_logs_tail:
+            The maximum number of lines, from the end of the container logs, to fetch when
+            logging the container output. Since the fetched logs are held in memory, this is also
+            what caps the memory used. Pass ``"all"`` to fetch all of them.
+        :keyword float container_status_ttl:
+            The number of seconds the container status is cached for, to avoid querying the docker
+            daemon each time :py:meth:`~saltfactories.daemons.container.Container.is_running` is called.
+        :keyword bool serial_callbacks:
+            When ``True``, the before/after start/terminate callbacks are run one after the other,
+            in the order they were registered, instead of concurrently. Use it when callbacks
+            depend on each other.
+        :keyword bool use_events:
+            When ``True``, the default, the docker events stream is used to wait for the container
+            to start instead of polling the container status. Set it to ``False`` when the
+            docker daemon does not support filtering events by container.
     """
 
     image = attr.ib()
@@ -156,13 +148,21 @@ class Container(BaseFactory):
     pull_before_start = attr.ib(repr=False, default=True)
     skip_on_pull_failure = attr.ib(repr=False, default=False)
     skip_if_docker_client_not_connectable = attr.ib(repr=False, default=False)
+    docker_client_pool_size = attr.ib(repr=False, default=None)
     docker_client = attr.ib(repr=False)
+    initial_poll_interval = attr.ib(repr=False, default=0.02)
+    max_poll_interval = attr.ib(repr=False, default=0.5)
+    container_logs_tail = attr.ib(repr=False, default=10000)
+    container_status_ttl = attr.ib(repr=False, default=0.1)
+    serial_callbacks = attr.ib(repr=False, default=False)
+    use_events = attr.ib(repr=False, default=True)
     _before_start_callbacks = attr.ib(repr=False, hash=False, default=attr.Factory(list))
     _before_terminate_callbacks = attr.ib(repr=False, hash=False, default=attr.Factory(list))
     _after_start_callbacks = attr.ib(repr=False, hash=False, default=attr.Factory(list))
     _after_terminate_callbacks = attr.ib(repr=False, hash=False, default=attr.Factory(list))
     _container_start_checks_callbacks = attr.ib(repr=False, hash=False, factory=list)
     _terminate_result = attr.ib(repr=False, hash=False, init=False, default=None)
+    _container_status = attr.ib(repr=False, hash=False, init=False)
 
     def __attrs_post_init__(self):
         """
@@ -197,6 +197,10 @@ class Container(BaseFactory):
     def _default_name(self):
         return random_string("factories-")
 
+    @_container_status.default
+    def _default_container_status(self):
+        return _ContainerStatus(docker_client=self.docker_client, ttl=self.container_status_ttl)
+
     @docker_client.default
     def _default_docker_client(self):
         exc_kwargs = {}
@@ -215,8 +219,8 @@ class Container(BaseFactory):
             else:
                 pytest.fail(message)
         try:
-            docker_client = docker.from_env()
-        except DockerException as exc:
+            docker_client = _get_default_docker_client(max_pool_size=self.docker_client_pool_size)
+        except _get_docker().errors.DockerException as exc:
             message = "Failed to instantiate the docker client: {}".format(exc)
             if self.skip_if_docker_client_not_connectable:
                 raise pytest.skip.Exception(message, **exc_kwargs) from exc
@@ -236,7 +240,7 @@ class Container(BaseFactory):
         :keyword kwargs:
             The keyword arguments to pass to the callback
         """
-        self._before_start_callbacks.append(Callback(func=callback, args=args, kwargs=kwargs))
+        self._before_start_callbacks.append(_Callback(func=callback, args=args, kwargs=kwargs))
 
     def after_start(self, callback, *args, **kwargs):
         """
@@ -249,7 +253,7 @@ class Container(BaseFactory):
         :keyword kwargs:
             The keyword arguments to pass to the callback
         """
-        self._after_start_callbacks.append(Callback(func=callback, args=args, kwargs=kwargs))
+        self._after_start_callbacks.append(_Callback(func=callback, args=args, kwargs=kwargs))
 
     def before_terminate(self, callback, *args, **kwargs):
         """
@@ -262,7 +266,7 @@ class Container(BaseFactory):
         :keyword kwargs:
             The keyword arguments to pass to the callback
         """
-        self._before_terminate_callbacks.append(Callback(func=callback, args=args, kwargs=kwargs))
+        self._before_terminate_callbacks.append(_Callback(func=callback, args=args, kwargs=kwargs))
 
     def after_terminate(self, callback, *args, **kwargs):
         """
@@ -275,7 +279,7 @@ class Container(BaseFactory):
         :keyword kwargs:
             The keyword arguments to pass to the callback
         """
-        self._after_terminate_callbacks.append((callback, args, kwargs))
+        self._after_terminate_callbacks.append(_Callback(func=callback, args=args, kwargs=kwargs))
 
     def container_start_check(self, callback, *args, **kwargs):
         """
@@ -307,7 +311,7 @@ class Container(BaseFactory):
             The keyword arguments to pass to the callback
         """
         self._container_start_checks_callbacks.append(
-            Callback(func=callback, args=args, kwargs=kwargs)
+            _Callback(func=callback, args=args, kwargs=kwargs)
         )
 
     def get_display_name(self):
@@ -326,20 +330,11 @@ class Container(BaseFactory):
             log.warning("%s is already running.", self)
             return True
         self._terminate_result = None
-        atexit.register(self.terminate)
+        _register_started_container(self)
         factory_started = False
-        for callback in self._before_start_callbacks:
-            try:
-                callback()
-            except Exception as exc:  # pragma: no cover pylint: disable=broad-except
-                log.info(
-                    "Exception raised when running %s: %s",
-                    callback,
-                    exc,
-                    exc_info=True,
-                )
+        _run_callbacks(self._before_start_callbacks, serial=self.serial_callbacks)
 
-        start_time = time.time()
+        start_time = time.monotonic_ns()
         start_attempts = max_start_attempts or self.max_start_attempts
         current_attempt = 0
         while current_attempt <= start_attempts:
@@ -347,10 +342,15 @@ class Container(BaseFactory):
             if factory_started:
                 break
             log.info("Starting %s. Attempt: %d of %d", self, current_attempt, start_attempts)
+            # The docker events stream and the container start checks callbacks expect wall clock
+            # timestamps, while the deadline we compute for ourselves uses the monotonic clock,
+            # in integer nanoseconds
             current_start_time = time.time()
             start_running_timeout = current_start_time + (start_timeout or self.start_timeout)
+            deadline = time.monotonic_ns() + int((start_timeout or self.start_timeout) * 1e9)
 
             # Start the container
+            self._container_status.clear()
             self.container = self.docker_client.containers.run(
                 self.image,
                 name=self.name,
@@ -359,27 +359,46 @@ class Container(BaseFactory):
                 command=list(command) or None,
                 **self.container_run_kwargs,
             )
-            while time.time() <= start_running_timeout:
-                # Don't know why, but if self.container wasn't previously in a running
-                # state, and now it is, we have to re-set the self.container attribute
-                # so that it gives valid status information
-                self.container = self.docker_client.containers.get(self.name)
-                if self.container.status != "running":
-                    time.sleep(0.25)
+            if self.use_events and (
+                _wait_for_container_start(
+                    self.docker_client, self.container.id, current_start_time, start_running_timeout
+                )
+                is False
+            ):
+                # The container died before we could confirm it's running status, re-try
+                log.warning("%s died while starting", self)
+                self._remove_container()
+                continue
+            status_poll_intervals = _poll_intervals(
+                self.initial_poll_interval, self.max_poll_interval
+            )
+            start_checks_poll_intervals = _poll_intervals(
+                self.initial_poll_interval, self.max_poll_interval
+            )
+            last_state = None
+            while True:
+                now = time.monotonic_ns()
+                if now > deadline:
+                    # We reached start_running_timeout, re-try
+                    self._remove_container()
+                    break
+                state = self._container_status.fetch(self.container.id)
+                if state != last_state:
+                    log.debug("%s container state: %s", self, state)
+                    last_state = state
+                if state != "running":
+                    time.sleep(min(next(status_poll_intervals), (deadline - now) / 1e9))
                     continue
 
-                self.container = self.docker_client.containers.get(self.name)
-                logs = self.container.logs(stdout=True, stderr=True, stream=False)
-                if isinstance(logs, bytes):
-                    stdout = logs.decode()
-                    stderr = None
-                else:
-                    stdout = logs[0].decode()
-                    stderr = logs[1].decode()
-                if stdout and stderr:
-                    log.info("Running Container Logs:\n%s\n%s", stdout, stderr)
-                elif stdout:
-                    log.info("Running Container Logs:\n%s", stdout)
+                # Now that the container is running, refresh the self.container attributes
+                self.container = self.docker_client.containers.get(self.container.id)
+                # Don't fetch the container logs unless they are going to be logged
+                if log.isEnabledFor(logging.INFO):
+                    stdout, stderr = _get_container_logs(self.container, self.container_logs_tail)
+                    if stdout and stderr:
+                        log.info("Running Container Logs:\n%s\n%s", stdout, stderr)
+                    elif stdout:
+                        log.info("Running Container Logs:\n%s", stdout)
 
                 # If we reached this far it means that we got the running status above, and
                 # now that the container has started, run start checks
@@ -388,7 +407,12 @@ class Container(BaseFactory):
                         self.run_container_start_checks(current_start_time, start_running_timeout)
                         is False
                     ):
-                        time.sleep(0.5)
+                        time.sleep(
+                            min(
+                                next(start_checks_poll_intervals),
+                                max(deadline - time.monotonic_ns(), 0) / 1e9,
+                            )
+                        )
                         continue
                 except FactoryNotStarted:
                     self.terminate()
@@ -397,32 +421,15 @@ class Container(BaseFactory):
                     "The %s factory is running after %d attempts. Took %1.2f seconds",
                     self,
                     current_attempt,
-                    time.time() - start_time,
+                    (time.monotonic_ns() - start_time) / 1e9,
                 )
                 factory_started = True
                 break
-            else:
-                # We reached start_running_timeout, re-try
-                try:
-                    self.container.remove(force=True)
-                    self.container.wait()
-                except APIError:
-                    pass
-                self.container = None
         else:
             # The factory failed to confirm it's running status
             self.terminate()
         if factory_started:
-            for callback in self._after_start_callbacks:
-                try:
-                    callback()
-                except Exception as exc:  # pragma: no cover pylint: disable=broad-except
-                    log.info(
-                        "Exception raised when running %s: %s",
-                        callback,
-                        exc,
-                        exc_info=True,
-                    )
+            _run_callbacks(self._after_start_callbacks, serial=self.serial_callbacks)
             # TODO: Add containers to the processes stats?!
             # if self.factories_manager and self.factories_manager.stats_processes is not None:
             #    self.factories_manager.stats_processes[self.get_display_name()] = psutil.Process(
@@ -435,7 +442,7 @@ class Container(BaseFactory):
             "took {:.2f} seconds({:.2f} seconds each)".format(
                 self,
                 current_attempt - 1,
-                time.time() - start_time,
+                (time.monotonic_ns() - start_time) / 1e9,
                 start_timeout or self.start_timeout,
             ),
             process_result=result,
@@ -459,17 +466,8 @@ class Container(BaseFactory):
         if self._terminate_result is not None:
             # The factory is already terminated
             return self._terminate_result
-        atexit.unregister(self.terminate)
-        for callback in self._before_terminate_callbacks:
-            try:
-                callback()
-            except Exception as exc:  # pragma: no cover pylint: disable=broad-except
-                log.info(
-                    "Exception raised when running %s: %s",
-                    callback,
-                    exc,
-                    exc_info=True,
-                )
+        _unregister_started_container(self)
+        _run_callbacks(self._before_terminate_callbacks, serial=self.serial_callbacks)
         stdout = stderr = None
         try:
             if self.container is None:
@@ -477,38 +475,36 @@ class Container(BaseFactory):
             else:
                 container = self.container
             self.container = None
+            self._container_status.clear()
             if container is not None:
-                logs = container.logs(stdout=True, stderr=True, stream=False)
-                if isinstance(logs, bytes):
-                    stdout = logs.decode()
-                else:
-                    stdout = logs[0].decode()
-                    stderr = logs[1].decode()
+                stdout, stderr = _get_container_logs(container, self.container_logs_tail)
                 if stdout and stderr:
                     log.info("Stopped Container Logs:\n%s\n%s", stdout, stderr)
                 elif stdout:
                     log.info("Stopped Container Logs:\n%s", stdout)
                 try:
                     container.remove(force=True)
-                    container.wait()
-                except APIError:
+                except _get_docker().errors.APIError:
                     pass
-        except NotFound:
+        except _get_docker().errors.NotFound:
             pass
         finally:
-            for callback in self._after_terminate_callbacks:
-                try:
-                    callback()
-                except Exception as exc:  # pragma: no cover pylint: disable=broad-except
-                    log.info(
-                        "Exception raised when running %s: %s",
-                        callback,
-                        exc,
-                        exc_info=True,
-                    )
+            _run_callbacks(self._after_terminate_callbacks, serial=self.serial_callbacks)
         self._terminate_result = ProcessResult(returncode=0, stdout=stdout, stderr=stderr)
         return self._terminate_result
 
+    def _remove_container(self):
+        """
+        Remove the container, if any.
+        """
+        try:
+            # A forced removal kills the container and only returns once it's removed
+            self.container.remove(force=True)
+        except _get_docker().errors.APIError:
+            pass
+        self.container = None
+        self._container_status.clear()
+
     def get_check_ports(self):
         """
         Return a list of TCP ports to check against to ensure the daemon is running.
@@ -573,9 +569,7 @@ class Container(BaseFactory):
         """
         if self.container is None:
             return False
-
-        self.container = self.docker_client.containers.get(self.name)
-        return self.container.status == "running"
+        return self._container_status.get(self.container.id) == "running"
 
     def run(self, *cmd, **kwargs):
         """
@@ -584,8 +578,11 @@ class Container(BaseFactory):
         if len(cmd) == 1:
             cmd = cmd[0]
         log.info("%s is running %r ...", self, cmd)
+        # Only look up the container when we don't already have it, exec_run just needs its id
+        container = self.container
+        if container is None:
+            container = self.docker_client.containers.get(self.name)
         # We force dmux to True so that we always get back both stdout and stderr
-        container = self.docker_client.containers.get(self.name)
         ret = container.exec_run(cmd, demux=True, **kwargs)
         returncode = ret.exit_code
         stdout = stderr = None
@@ -601,13 +598,10 @@ class Container(BaseFactory):
     def client_connectable(docker_client):
         """
         Check if the docker client can connect to the docker daemon.
+
+        The docker daemon is only pinged once for each docker client.
         """
-        try:
-            if not docker_client.ping():
-                return "The docker client failed to get a ping response from the docker daemon"
-            return True
-        except (APIError, RequestsConnectionError, PyWinTypesError) as exc:
-            return "The docker client failed to ping the docker server: {}".format(exc)
+        return _client_connectable(docker_client)
 
     def run_container_start_checks(
         self,
@@ -622,7 +616,7 @@ class Container(BaseFactory):
         if not start_check_callbacks:
             log.debug("No container start check callbacks to run for %s", self)
             return True
-        checks_start_time = time.time()
+        checks_start_time = time.monotonic()
         log.debug("%s is running container start checks", self)
         while time.time() <= timeout_at:
             if not self.is_running():
@@ -645,7 +639,7 @@ class Container(BaseFactory):
             log.error(
                 "Failed to run container start check callbacks after %1.2f seconds for %s. "
                 "Remaining container start check callbacks: %s",
-                time.time() - checks_start_time,
+                time.monotonic() - checks_start_time,
                 self,
                 start_check_callbacks,
             )
@@ -661,33 +655,37 @@ class Container(BaseFactory):
         to accept work by trying to connect to each of the ports it's supposed
         to be listening.
         """
-        check_ports_mapping = self.get_check_ports().copy()
+        check_ports_mapping = self.get_check_ports()
         if not check_ports_mapping:
             log.debug("No ports to check connection to for %s", self)
             return True
         log.debug("Listening ports to check for %s: %s", self, check_ports_mapping)
-        checks_start_time = time.time()
+        checks_start_time = time.monotonic()
         check_ports = set(check_ports_mapping.values())
         while time.time() <= timeout_at:
             if not self.is_running():
                 raise FactoryNotStarted("{} is no longer running".format(self))
             if not check_ports:
                 break
-            check_ports -= ports.get_connectable_ports(check_ports)
+            # Update the remaining ports in place, the mapping is only needed when reporting
+            check_ports.difference_update(
+                _get_connectable_ports(check_ports, min(max(timeout_at - time.time(), 0), 1))
+            )
             if check_ports:
-                for container_binding, host_binding in check_ports_mapping.copy().items():
-                    if host_binding not in check_ports:
-                        check_ports_mapping.pop(container_binding)
                 time.sleep(0.5)
         else:
             log.error(
                 "Failed to check ports after %1.2f seconds for %s. Remaining ports to check: %s",
-                time.time() - checks_start_time,
+                time.monotonic() - checks_start_time,
                 self,
-                check_ports_mapping,
+                {
+                    container_binding: host_binding
+                    for container_binding, host_binding in check_ports_mapping.items()
+                    if host_binding in check_ports
+                },
             )
             return False
-        log.debug("All listening ports checked for %s: %s", self, self.get_check_ports())
+        log.debug("All listening ports checked for %s: %s", self, check_ports_mapping)
         return True
 
     def _check_for_connectable_docker_client(self):
@@ -708,7 +706,7 @@ class Container(BaseFactory):
         log.info("Pulling docker image '%s' before starting it", self.image)
         try:
             self.docker_client.images.pull(self.image)
-        except APIError as exc:
+        except _get_docker().errors.APIError as exc:
             if self.skip_on_pull_failure:
                 exc_kwargs = {}
                 if PYTEST_GE_7:
@@ -749,6 +747,7 @@ class SaltDaemon(Container, bases.SaltDaemon):
 
     _daemon_started = attr.ib(init=False, repr=False, default=False)
     _daemon_starting = attr.ib(init=False, repr=False, default=False)
+    _cmdline_prefix = attr.ib(init=False, repr=False, default=None)
 
     def __attrs_post_init__(self):
         """
@@ -777,6 +776,8 @@ class SaltDaemon(Container, bases.SaltDaemon):
         self.container_run_kwargs.setdefault("hostname", self.name)
         self.container_run_kwargs.setdefault("remove", True)
         self.container_run_kwargs.setdefault("auto_remove", True)
+        # The container name doesn't change, so, neither does the command line prefix
+        self._cmdline_prefix = ("docker", "exec", "-i", self.name)
         log.debug("%s container_run_kwargs: %s", self, self.container_run_kwargs)
 
     def get_display_name(self):
@@ -799,7 +800,7 @@ class SaltDaemon(Container, bases.SaltDaemon):
             Additional arguments to use when starting the container
 
         """
-        return ["docker", "exec", "-i", self.name] + super().cmdline(*args)
+        return [*self._cmdline_prefix, *super().cmdline(*args)]
 
     def start(self, *extra_cli_arguments, max_start_attempts=None, start_timeout=None):
         """
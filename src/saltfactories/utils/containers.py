@@ -0,0 +1,467 @@
+"""
+Container factories related utilities.
+
+These are internal helpers of :py:mod:`saltfactories.daemons.container`.
+
+The docker library, along with requests and, on windows, pywintypes, are only imported
+when actually needed since docker has a big import tree, and collecting tests which do
+not use containers shouldn't pay for it.
+
+..
+    PYTEST_DONT_REWRITE
+"""
+import atexit
+import contextlib
+import errno
+import functools
+import logging
+import random
+import selectors
+import socket
+import struct
+import threading
+import weakref
+
+import attr
+from pytestshellutils.customtypes import Callback
+from pytestshellutils.utils import time
+
+from saltfactories import IS_WINDOWS
+
+log = logging.getLogger(__name__)
+
+# Default docker clients, keyed by their maximum connection pool size
+_DEFAULT_DOCKER_CLIENTS = {}
+# Docker clients which already got a ping response from the docker daemon
+_CONNECTABLE_DOCKER_CLIENTS = weakref.WeakSet()
+# Started container factories, keyed by id(), which need to be terminated at exit
+_STARTED_CONTAINERS = {}
+_STARTED_CONTAINERS_ATEXIT_REGISTERED = False
+# The maximum number of container factories to terminate concurrently at exit
+_MAX_CONCURRENT_TERMINATIONS = 16
+# The maximum number of container callbacks to run concurrently
+_MAX_CONCURRENT_CALLBACKS = 8
+
+
+def _get_docker():
+    """
+    Import, on first use, and return the docker library.
+    """
+    import docker  # pylint: disable=import-outside-toplevel
+
+    return docker
+
+
+def _get_docker_connection_errors():
+    """
+    Return the exceptions raised when the docker client fails to talk to the docker daemon.
+    """
+    # pylint: disable=import-outside-toplevel
+    from requests.exceptions import ConnectionError as RequestsConnectionError
+
+    errors = (_get_docker().errors.APIError, RequestsConnectionError)
+    if IS_WINDOWS:  # pragma: no cover
+        try:
+            import pywintypes
+
+            errors += (pywintypes.error,)
+        except ImportError:
+            pass
+    # pylint: enable=import-outside-toplevel
+    return errors
+
+
+def _get_default_docker_client(max_pool_size=None):
+    """
+    Return the docker client shared by all container factories, instantiating it if needed.
+
+    One client is shared per ``max_pool_size``, ``None`` meaning the docker library default.
+    The clients, and their connection pools, are closed when the interpreter exits.
+    """
+    docker_client = _DEFAULT_DOCKER_CLIENTS.get(max_pool_size)
+    if docker_client is None:
+        from_env_kwargs = {}
+        if max_pool_size is not None:
+            from_env_kwargs["max_pool_size"] = max_pool_size
+        docker_client = _get_docker().from_env(**from_env_kwargs)
+        weakref.finalize(docker_client, docker_client.close)
+        _DEFAULT_DOCKER_CLIENTS[max_pool_size] = docker_client
+    return docker_client
+
+
+def _client_connectable(docker_client):
+    """
+    Check if the docker client can connect to the docker daemon, only pinging it once per client.
+    """
+    if docker_client in _CONNECTABLE_DOCKER_CLIENTS:
+        return True
+    try:
+        if not docker_client.ping():
+            return "The docker client failed to get a ping response from the docker daemon"
+        _CONNECTABLE_DOCKER_CLIENTS.add(docker_client)
+        return True
+    except _get_docker_connection_errors() as exc:
+        return "The docker client failed to ping the docker server: {}".format(exc)
+
+
+def _wait_for_container_event(docker_client, container_id, actions, started_at, timeout_at):
+    """
+    Block on the docker events stream until one of ``actions`` happens to the container.
+
+    Returns the action, or ``None`` if the events stream failed, or ended, or if ``timeout_at``
+    was reached.
+    """
+    if docker_client.api.base_url.startswith("http+docker://ssh"):
+        # The docker library can't cancel streams over SSH, so there would be no way to stop
+        # waiting once ``timeout_at`` is reached
+        return None
+    try:
+        events = docker_client.events(
+            since=int(started_at),
+            # The docker daemon closes the events stream once ``until`` is reached
+            until=int(timeout_at) + 1,
+            filters={"container": container_id, "event": list(actions)},
+            decode=True,
+        )
+    except _get_docker_connection_errors() as exc:
+        log.warning("Failed to subscribe to the docker events stream for %s: %s", container_id, exc)
+        return None
+    # The docker library doesn't set a read timeout on the events stream, and the daemon
+    # only honors ``until`` by its own clock, so close the stream ourselves once
+    # ``timeout_at`` is reached
+    timed_out = threading.Event()
+
+    def _on_timeout():
+        timed_out.set()
+        _close_events_stream(events)
+
+    watchdog = threading.Timer(max(timeout_at - time.time(), 0), _on_timeout)
+    watchdog.daemon = True
+    watchdog.start()
+    try:
+        for event in events:
+            action = event.get("status") or event.get("Action")
+            log.debug("%s received docker event: %s", container_id, action)
+            if action in actions:
+                return action
+    except Exception as exc:  # pylint: disable=broad-except
+        if timed_out.is_set():
+            # Closing the stream from the watchdog makes the pending read fail
+            return None
+        if not isinstance(exc, _get_docker_connection_errors()):
+            raise
+        log.warning("Failed to read the docker events stream for %s: %s", container_id, exc)
+    finally:
+        watchdog.cancel()
+        watchdog.join()
+        if not timed_out.is_set():
+            _close_events_stream(events)
+    return None
+
+
+def _close_events_stream(events):
+    try:
+        events.close()
+    except _get_docker().errors.DockerException as exc:
+        log.debug("Failed to close the docker events stream: %s", exc)
+
+
+def _wait_for_container_start(docker_client, container_id, started_at, timeout_at):
+    """
+    Wait until the container starts or dies.
+
+    Returns ``True`` if the container started, ``False`` if it died, or ``None`` if that's
+    not known, for example, because ``timeout_at`` was reached.
+
+    The container state is checked first, since, when the docker daemon clock lags behind
+    ours, the ``start`` event might be older than ``started_at`` and never get replayed.
+    Only if the container isn't running yet is the docker events stream blocked on.
+    """
+    state = _get_container_state(docker_client, container_id)
+    if state == "running":
+        return True
+    if state in (None, "exited", "dead"):
+        return False
+    action = _wait_for_container_event(
+        docker_client, container_id, ("start", "die"), started_at, timeout_at
+    )
+    if action is None:
+        return None
+    return action == "start"
+
+
+def _get_container_state(docker_client, container_id):
+    """
+    Return the container state, or ``None`` if the container no longer exists.
+
+    Listing the containers, filtered by id, is much cheaper than fully inspecting the container.
+    """
+    containers = docker_client.api.containers(all=True, filters={"id": container_id})
+    return containers[0]["State"] if containers else None
+
+
+@attr.s(kw_only=True, slots=True)
+class _ContainerStatus:
+    """
+    Cache of a container status, to avoid querying the docker daemon on every status check.
+
+    The cached status is valid for ``ttl`` seconds.
+    """
+
+    docker_client = attr.ib()
+    ttl = attr.ib()
+    # The time to live in integer nanoseconds, to compare against time.monotonic_ns() deltas
+    _ttl_ns = attr.ib(init=False)
+    # A (time.monotonic_ns(), status) tuple
+    _cached = attr.ib(init=False, default=None)
+
+    @_ttl_ns.default
+    def _default_ttl_ns(self):
+        return int(self.ttl * 1e9)
+
+    def clear(self):
+        """
+        Clear the cached status.
+        """
+        self._cached = None
+
+    def set(self, status):
+        """
+        Cache the passed status.
+        """
+        self._cached = (time.monotonic_ns(), status)
+
+    def fetch(self, container_id):
+        """
+        Fetch, and cache, the container state, or ``None`` if the container no longer exists.
+        """
+        state = _get_container_state(self.docker_client, container_id)
+        self.set(state)
+        return state
+
+    def get(self, container_id):
+        """
+        Return the container status, or ``None`` if the container no longer exists.
+        """
+        if self._cached is not None:
+            cached_at, status = self._cached
+            if time.monotonic_ns() - cached_at < self._ttl_ns:
+                return status
+        try:
+            status = self.docker_client.api.inspect_container(container_id)["State"]["Status"]
+        except _get_docker().errors.NotFound:
+            status = None
+        self.set(status)
+        return status
+
+
+def _get_container_logs(container, tail):
+    """
+    Return the container logs, as a ``(stdout, stderr)`` tuple.
+
+    The docker library can't demux the container logs, so they are requested, once, from the
+    docker API, and split by output while reading the response. Only the last ``tail`` lines are
+    fetched, which is what bounds the memory used.
+    """
+    # pylint: disable=import-outside-toplevel
+    from requests.exceptions import HTTPError
+
+    # pylint: enable=import-outside-toplevel
+    api = container.client.api
+    response = api.get(
+        "{}/v{}/containers/{}/logs".format(api.base_url, api.api_version, container.id),
+        params={"stdout": 1, "stderr": 1, "timestamps": 0, "follow": 0, "tail": tail},
+        stream=True,
+        timeout=api.timeout,
+    )
+    with contextlib.closing(response):
+        try:
+            response.raise_for_status()
+        except HTTPError as exc:
+            _get_docker().errors.create_api_error_from_http_exception(exc)
+        if container.attrs["Config"]["Tty"]:
+            # With a TTY, the container outputs are not multiplexed and can't be told apart
+            return response.content.decode("utf-8", errors="replace") or None, None
+        # Each frame is prefixed by an 8 bytes header, holding the stream it belongs to, 1 for
+        # stdout and 2 for stderr, and the frame length
+        stdout = []
+        stderr = []
+        while True:
+            header = response.raw.read(8)
+            if len(header) < 8:
+                break
+            stream, length = struct.unpack(">BxxxL", header)
+            (stderr if stream == 2 else stdout).append(response.raw.read(length))
+    return tuple(
+        b"".join(output).decode("utf-8", errors="replace") or None for output in (stdout, stderr)
+    )
+
+
+@attr.s(kw_only=True, frozen=True)
+class _Callback(Callback):
+    """
+    Callback which only formats it's string representation once, when registered.
+    """
+
+    _str = attr.ib(init=False, repr=False, eq=False)
+
+    @_str.default
+    def _default_str(self):
+        if not hasattr(self.func, "__qualname__") and not hasattr(self.func, "__name__"):
+            # Callables like functools.partial have neither a __qualname__ nor a __name__
+            return repr(self)
+        return Callback.__str__(self)
+
+    def __str__(self):
+        """
+        String representation of the class.
+        """
+        return self._str
+
+
+def _run_callbacks(callbacks, serial=False):
+    """
+    Run the passed callbacks, concurrently unless ``serial`` is ``True``.
+
+    Exceptions raised by the callbacks are logged. Pytest outcomes, like skips or failures,
+    are re-raised, in the callbacks registration order, once all callbacks finish running.
+    """
+    if serial or len(callbacks) < 2:
+        for callback in callbacks:
+            _run_callback(callback)
+        return
+    _run_concurrently(
+        [functools.partial(_run_callback, callback) for callback in callbacks],
+        _MAX_CONCURRENT_CALLBACKS,
+    )
+
+
+def _run_callback(callback):
+    try:
+        callback()
+    except Exception as exc:  # pragma: no cover pylint: disable=broad-except
+        log.info(
+            "Exception raised when running %s: %s",
+            callback,
+            exc,
+            exc_info=True,
+        )
+
+
+def _register_started_container(factory):
+    """
+    Register a started container factory so that it gets terminated at exit.
+    """
+    global _STARTED_CONTAINERS_ATEXIT_REGISTERED  # pylint: disable=global-statement
+    _STARTED_CONTAINERS[id(factory)] = factory
+    if not _STARTED_CONTAINERS_ATEXIT_REGISTERED:
+        atexit.register(_terminate_started_containers)
+        _STARTED_CONTAINERS_ATEXIT_REGISTERED = True
+
+
+def _unregister_started_container(factory):
+    """
+    Unregister a container factory from being terminated at exit.
+    """
+    _STARTED_CONTAINERS.pop(id(factory), None)
+
+
+def _terminate_started_containers():
+    """
+    Concurrently terminate the container factories which are still started at exit.
+    """
+    _run_concurrently(
+        [factory.terminate for factory in _STARTED_CONTAINERS.values()],
+        _MAX_CONCURRENT_TERMINATIONS,
+    )
+
+
+def _run_concurrently(funcs, max_concurrency):
+    """
+    Run the passed functions concurrently, at most ``max_concurrency`` at a time.
+
+    Plain threads are used because, at exit, ``concurrent.futures`` executors no longer
+    accept work. Some Python versions, like 3.12.0 and 3.12.1, don't even allow starting
+    new threads at exit, in which case the remaining functions are run serially. Once all
+    functions finish running, the first exception raised, in the ``funcs`` order, is re-raised.
+    """
+    funcs = list(funcs)
+    errors = [None] * len(funcs)
+
+    def _run(idx):
+        try:
+            funcs[idx]()
+        except BaseException as exc:  # pylint: disable=broad-except
+            errors[idx] = exc
+
+    can_start_threads = True
+    for batch_start in range(0, len(funcs), max_concurrency):
+        threads = []
+        for idx in range(batch_start, min(batch_start + max_concurrency, len(funcs))):
+            if can_start_threads:
+                thread = threading.Thread(target=_run, args=(idx,))
+                try:
+                    thread.start()
+                except RuntimeError:
+                    # Can't create new threads at interpreter shutdown
+                    can_start_threads = False
+                else:
+                    threads.append(thread)
+                    continue
+            _run(idx)
+        for thread in threads:
+            thread.join()
+    for exc in errors:
+        if exc is not None:
+            raise exc
+
+
+def _poll_intervals(initial, maximum):
+    """
+    Yield exponentially increasing poll intervals, with some jitter, capped at ``maximum``.
+    """
+    interval = initial
+    while True:
+        yield interval + random.uniform(0, interval * 0.1)
+        interval = min(interval * 2, maximum)
+
+
+def _get_connectable_ports(check_ports, timeout):
+    """
+    Return the ports, out of ``check_ports``, which we can connect to.
+
+    The connections to all ports are attempted concurrently, using non-blocking sockets,
+    waiting at most ``timeout`` seconds for them to complete.
+    """
+    connectable_ports = set()
+    with selectors.DefaultSelector() as selector:
+        try:
+            for port in check_ports:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                conn = sock.connect_ex(("localhost", port))
+                if conn not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    sock.close()
+                    continue
+                selector.register(sock, selectors.EVENT_WRITE, port)
+            deadline = time.monotonic_ns() + int(timeout * 1e9)
+            while selector.get_map():
+                now = time.monotonic_ns()
+                if now >= deadline:
+                    break
+                for key, _ in selector.select(timeout=(deadline - now) / 1e9):
+                    selector.unregister(key.fileobj)
+                    with contextlib.closing(key.fileobj) as sock:
+                        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                            continue
+                        log.debug("Port %s is connectable!", key.data)
+                        connectable_ports.add(key.data)
+                        try:
+                            sock.shutdown(socket.SHUT_RDWR)
+                        except OSError:  # pragma: no cover
+                            pass
+        finally:
+            for key in list(selector.get_map().values()):
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+    return connectable_ports
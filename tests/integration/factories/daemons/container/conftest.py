@@ -1,6 +1,7 @@
 import pytest
 
 from saltfactories.daemons.container import Container
+from saltfactories.utils.containers import _get_default_docker_client
 
 docker = pytest.importorskip("docker")
 from docker.errors import DockerException  # noqa: E402
@@ -9,7 +10,7 @@ from docker.errors import DockerException  # noqa: E402
 @pytest.fixture(scope="session")
 def docker_client():
     try:
-        client = docker.from_env()
+        client = _get_default_docker_client()
     except DockerException:
         pytest.skip("Failed to get a connection to docker running on the system")
     connectable = Container.client_connectable(client)
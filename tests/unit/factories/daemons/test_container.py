@@ -1,10 +1,25 @@
+import functools
 from unittest import mock
 
 import pytest
+from pytestshellutils.customtypes import Callback
+from pytestshellutils.utils import time
 
 from saltfactories.daemons.container import Container
 
 
+@pytest.fixture
+def docker_client():
+    return mock.MagicMock()
+
+
+@pytest.fixture
+def container(docker_client):
+    container = Container(name="foo", image="bar", docker_client=docker_client)
+    container.container = mock.MagicMock(id="abc")
+    return container
+
+
 def test_missing_docker_library():
     with mock.patch(
         "saltfactories.daemons.container.HAS_DOCKER",
@@ -28,3 +43,85 @@ def test_missing_requests_library():
             Container(name="foo", image="bar")
 
         assert str(exc.value) == "The requests python library was not found installed"
+
+
+def test_default_docker_client_is_shared():
+    pytest.importorskip("docker")
+    with mock.patch.dict(
+        "saltfactories.utils.containers._DEFAULT_DOCKER_CLIENTS", clear=True
+    ), mock.patch("docker.from_env", side_effect=lambda **_: mock.MagicMock()) as from_env:
+        assert (
+            Container(name="foo", image="bar").docker_client
+            is Container(name="bar", image="bar").docker_client
+        )
+        from_env.assert_called_once_with()
+        pooled_docker_client = Container(
+            name="foo", image="bar", docker_client_pool_size=32
+        ).docker_client
+        assert pooled_docker_client is not Container(name="foo", image="bar").docker_client
+        from_env.assert_called_with(max_pool_size=32)
+
+
+def test_client_connectable_pings_once(docker_client):
+    docker_client.ping.return_value = True
+    assert Container.client_connectable(docker_client) is True
+    assert Container.client_connectable(docker_client) is True
+    docker_client.ping.assert_called_once_with()
+
+
+def test_run_reuses_container(docker_client, container):
+    container.container.exec_run.return_value = mock.MagicMock(exit_code=0, output=(b"foo\n", None))
+    ret = container.run("echo", "foo")
+    assert ret.returncode == 0
+    assert ret.stdout == "foo\n"
+    assert ret.stderr is None
+    container.container.exec_run.assert_called_once_with(("echo", "foo"), demux=True)
+    docker_client.containers.get.assert_not_called()
+
+
+def test_callbacks_string_formatted_once(container):
+    def callback(*args, **kwargs):
+        pass
+
+    container.after_terminate(callback, 1, foo="bar")
+    registered = container._after_terminate_callbacks[-1]
+    assert str(registered) == str(Callback(func=callback, args=(1,), kwargs={"foo": "bar"}))
+    with mock.patch.object(Callback, "__str__") as callback_str:
+        str(registered)
+        callback_str.assert_not_called()
+
+
+def test_register_callback_without_name(container):
+    callback = functools.partial(print, "foo")
+    container.after_terminate(callback)
+    assert repr(callback) in str(container._after_terminate_callbacks[-1])
+
+
+def test_check_listening_ports(container):
+    with mock.patch.object(
+        Container, "get_check_ports", return_value={4505: 14505, 4506: 14506}
+    ) as get_check_ports, mock.patch.object(Container, "is_running", return_value=True), mock.patch(
+        "saltfactories.daemons.container._get_connectable_ports",
+        side_effect=[{14505}, {14506}],
+    ) as get_connectable_ports, mock.patch(
+        "saltfactories.daemons.container.time.sleep"
+    ):
+        assert container._check_listening_ports(time.time() + 30) is True
+    get_check_ports.assert_called_once_with()
+    assert get_connectable_ports.call_count == 2
+
+
+def test_is_running_caches_container_status(docker_client):
+    pytest.importorskip("docker")
+    docker_client.api.inspect_container.return_value = {"State": {"Status": "running"}}
+    container = Container(
+        name="foo", image="bar", docker_client=docker_client, container_status_ttl=30
+    )
+    assert container.is_running() is False
+    container.container = mock.MagicMock(id="abc")
+    assert container.is_running() is True
+    assert container.is_running() is True
+    docker_client.api.inspect_container.assert_called_once_with("abc")
+    container._container_status.set("exited")
+    assert container.is_running() is False
+    docker_client.api.inspect_container.assert_called_once_with("abc")
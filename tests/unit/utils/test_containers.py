@@ -0,0 +1,315 @@
+"""
+Unit tests for the container factories related utilities.
+"""
+import contextlib
+import http.server
+import json
+import socket
+import struct
+import threading
+import urllib.parse
+from unittest import mock
+
+import pytest
+from pytestshellutils.utils import ports
+from pytestshellutils.utils import time
+
+from saltfactories.utils.containers import _Callback
+from saltfactories.utils.containers import _ContainerStatus
+from saltfactories.utils.containers import _get_connectable_ports
+from saltfactories.utils.containers import _get_container_logs
+from saltfactories.utils.containers import _poll_intervals
+from saltfactories.utils.containers import _register_started_container
+from saltfactories.utils.containers import _run_callbacks
+from saltfactories.utils.containers import _terminate_started_containers
+from saltfactories.utils.containers import _unregister_started_container
+from saltfactories.utils.containers import _wait_for_container_start
+
+
+@pytest.fixture
+def docker_client():
+    docker_client = mock.MagicMock()
+    docker_client.api.base_url = "http+docker://localhost"
+    docker_client.api.containers.return_value = [{"State": "created"}]
+    return docker_client
+
+
+@pytest.mark.parametrize(
+    "events,expected",
+    [
+        ([{"status": "start"}], True),
+        ([{"status": "die"}], False),
+        ([{"Action": "die"}, {"Action": "start"}], False),
+        ([], None),
+    ],
+)
+def test_wait_for_container_start(docker_client, events, expected):
+    stream = mock.MagicMock()
+    stream.__iter__.return_value = iter(events)
+    docker_client.events.return_value = stream
+    started_at = time.time()
+    assert _wait_for_container_start(docker_client, "abc", started_at, started_at + 30) is expected
+    docker_client.events.assert_called_once_with(
+        since=int(started_at),
+        until=int(started_at + 30) + 1,
+        filters={"container": "abc", "event": ["start", "die"]},
+        decode=True,
+    )
+    stream.close.assert_called_once_with()
+
+
+@pytest.mark.parametrize("state,expected", [("running", True), ("exited", False), (None, False)])
+def test_wait_for_container_start_checks_state_first(docker_client, state, expected):
+    docker_client.api.containers.return_value = [{"State": state}] if state else []
+    started_at = time.time()
+    assert _wait_for_container_start(docker_client, "abc", started_at, started_at + 30) is expected
+    docker_client.events.assert_not_called()
+
+
+def test_wait_for_container_start_times_out(docker_client):
+    closed = threading.Event()
+
+    def _events():
+        # Like a docker events stream which never gets any event
+        closed.wait()
+        raise ConnectionResetError()
+        yield  # pylint: disable=unreachable
+
+    stream = mock.MagicMock()
+    stream.__iter__.return_value = _events()
+    stream.close.side_effect = closed.set
+    docker_client.events.return_value = stream
+    started_at = time.time()
+    assert _wait_for_container_start(docker_client, "abc", started_at, started_at + 0.1) is None
+    assert time.time() - started_at < 5
+    stream.close.assert_called_once_with()
+
+
+def test_wait_for_container_start_over_ssh(docker_client):
+    docker_client.api.base_url = "http+docker://ssh"
+    started_at = time.time()
+    assert _wait_for_container_start(docker_client, "abc", started_at, started_at + 30) is None
+    docker_client.events.assert_not_called()
+
+
+def test_wait_for_container_start_ignores_stream_close_failures(docker_client):
+    docker = pytest.importorskip("docker")
+    stream = mock.MagicMock()
+    stream.__iter__.return_value = iter([])
+    stream.close.side_effect = docker.errors.DockerException("Cancellable streams not supported")
+    docker_client.events.return_value = stream
+    started_at = time.time()
+    assert _wait_for_container_start(docker_client, "abc", started_at, started_at + 30) is None
+    stream.close.assert_called_once_with()
+
+
+def test_poll_intervals():
+    intervals = _poll_intervals(0.02, 0.5)
+    previous = 0
+    for _ in range(5):
+        interval = next(intervals)
+        assert previous < interval
+        previous = interval
+    for _ in range(3):
+        assert 0.5 <= next(intervals) <= 0.55
+
+
+def test_get_connectable_ports():
+    with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as server:
+        server.bind(("localhost", 0))
+        server.listen(1)
+        listening_port = server.getsockname()[1]
+        unused_port = ports.get_unused_localhost_port()
+        assert _get_connectable_ports({listening_port, unused_port}, 1) == {listening_port}
+
+
+@pytest.mark.parametrize(
+    "containers,expected",
+    [
+        ([{"Id": "abc", "State": "running"}], "running"),
+        ([{"Id": "abc", "State": "exited"}], "exited"),
+        ([], None),
+    ],
+)
+def test_container_status_fetch(containers, expected):
+    docker_client = mock.MagicMock()
+    docker_client.api.containers.return_value = containers
+    container_status = _ContainerStatus(docker_client=docker_client, ttl=30)
+    assert container_status.fetch("abc") == expected
+    assert container_status.get("abc") == expected
+    docker_client.api.inspect_container.assert_not_called()
+    docker_client.api.containers.assert_called_once_with(all=True, filters={"id": "abc"})
+
+
+def test_container_status_expires(docker_client):
+    pytest.importorskip("docker")
+    docker_client.api.inspect_container.return_value = {"State": {"Status": "running"}}
+    container_status = _ContainerStatus(docker_client=docker_client, ttl=0)
+    container_status.set("exited")
+    assert container_status.get("abc") == "running"
+    docker_client.api.inspect_container.assert_called_once_with("abc")
+
+
+@contextlib.contextmanager
+def _fake_docker_daemon(tty, frames, requests):
+    """
+    Serve the container inspect and logs docker API endpoints over a real HTTP connection.
+    """
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        # Keep the connection alive, like the docker daemon does
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):  # pylint: disable=invalid-name
+            url = urllib.parse.urlparse(self.path)
+            requests.append(url)
+            if "/containers/abc/" not in url.path:
+                body = json.dumps({"message": "No such container"}).encode()
+                self.send_response(404)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            if url.path.endswith("/json"):
+                body = json.dumps({"Id": "abc", "Config": {"Tty": tty}}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            query = urllib.parse.parse_qs(url.query)
+            streams = {
+                stream for stream, param in ((1, "stdout"), (2, "stderr")) if query[param] == ["1"]
+            }
+            self.send_response(200)
+            self.send_header("Content-Type", "application/vnd.docker.raw-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for stream, frame in frames:
+                if stream not in streams:
+                    continue
+                if not tty:
+                    frame = struct.pack(">BxxxL", stream, len(frame)) + frame
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(frame), frame))
+            self.wfile.write(b"0\r\n\r\n")
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    try:
+        yield "tcp://127.0.0.1:{}".format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+@pytest.mark.parametrize(
+    "tty,frames,expected",
+    [
+        (False, [(1, b"foo\n"), (2, b"bar\n"), (1, b"baz\n")], ("foo\nbaz\n", "bar\n")),
+        (False, [(1, b"foo\n")], ("foo\n", None)),
+        (False, [], (None, None)),
+        (True, [(1, b"foo\n"), (2, b"bar\n")], ("foo\nbar\n", None)),
+    ],
+)
+def test_get_container_logs(tty, frames, expected):
+    docker = pytest.importorskip("docker")
+    requests = []
+    with _fake_docker_daemon(tty, frames, requests) as base_url:
+        docker_client = docker.DockerClient(base_url=base_url, version="1.41", timeout=5)
+        with contextlib.closing(docker_client):
+            docker_container = docker_client.containers.prepare_model(
+                {"Id": "abc", "Config": {"Tty": tty}}
+            )
+            assert _get_container_logs(docker_container, 10) == expected
+    logs_requests = [url for url in requests if url.path.endswith("/logs")]
+    assert len(logs_requests) == 1
+    query = urllib.parse.parse_qs(logs_requests[0].query)
+    assert query["tail"] == ["10"]
+    assert query["follow"] == ["0"]
+
+
+def test_get_container_logs_container_not_found():
+    docker = pytest.importorskip("docker")
+    with _fake_docker_daemon(False, [], []) as base_url:
+        docker_client = docker.DockerClient(base_url=base_url, version="1.41", timeout=5)
+        with contextlib.closing(docker_client):
+            docker_container = docker_client.containers.prepare_model(
+                {"Id": "def", "Config": {"Tty": False}}
+            )
+            with pytest.raises(docker.errors.NotFound):
+                _get_container_logs(docker_container, 10)
+
+
+def test_terminate_started_containers():
+    factories = [mock.MagicMock() for _ in range(20)]
+    with mock.patch.dict("saltfactories.utils.containers._STARTED_CONTAINERS", clear=True):
+        for factory in factories:
+            _register_started_container(factory)
+        _unregister_started_container(factories[0])
+        _terminate_started_containers()
+    factories[0].terminate.assert_not_called()
+    for factory in factories[1:]:
+        factory.terminate.assert_called_once_with()
+
+
+def test_terminate_started_containers_when_threads_cannot_start():
+    factories = [mock.MagicMock() for _ in range(20)]
+    thread_start = threading.Thread.start
+    started_threads = []
+
+    def _thread_start(thread):
+        if len(started_threads) == 3:
+            raise RuntimeError("can't create new thread at interpreter shutdown")
+        started_threads.append(thread)
+        thread_start(thread)
+
+    with mock.patch.dict(
+        "saltfactories.utils.containers._STARTED_CONTAINERS", clear=True
+    ), mock.patch.object(threading.Thread, "start", autospec=True, side_effect=_thread_start):
+        for factory in factories:
+            _register_started_container(factory)
+        _terminate_started_containers()
+    assert len(started_threads) == 3
+    for factory in factories:
+        factory.terminate.assert_called_once_with()
+
+
+@pytest.mark.parametrize("serial_callbacks", [True, False])
+def test_run_callbacks(serial_callbacks):
+    calls = []
+
+    def raise_error():
+        raise RuntimeError("Ignored")
+
+    callbacks = [
+        _Callback(func=calls.append, args=(1,), kwargs={}),
+        _Callback(func=raise_error, args=(), kwargs={}),
+        _Callback(func=calls.append, args=(2,), kwargs={}),
+    ]
+    _run_callbacks(callbacks, serial=serial_callbacks)
+    assert sorted(calls) == [1, 2]
+
+
+def test_run_callbacks_reraises_pytest_outcomes_in_order():
+    def skip():
+        time.sleep(0.1)
+        pytest.skip("Skipped!")
+
+    def fail():
+        pytest.fail("Failed!")
+
+    with pytest.raises(pytest.skip.Exception, match="Skipped!"):
+        _run_callbacks(
+            [
+                _Callback(func=skip, args=(), kwargs={}),
+                _Callback(func=fail, args=(), kwargs={}),
+            ]
+        )